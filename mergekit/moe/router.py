@@ -1,59 +1,335 @@
+# Copyright (C) 2024 Charles O. Goddard
+#
+# This software is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This software is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program. If not, see http://www.gnu.org/licenses/.
+
+import gc
+import logging
+import math
+from typing import Dict, List, Optional
+
 import torch
+import torch.nn as nn
 import tqdm
 import transformers
-from transformers import AutoModelForCausalLM, LlamaForCausalLM, MistralForCausalLM,AutoTokenizer, AutoModel
-from transformers.modeling_outputs import CausalLMOutputWithPast
+from transformers import AutoModel, AutoModelForCausalLM, AutoTokenizer
+from transformers.modeling_outputs import BaseModelOutputWithPast
 
 from mergekit.common import ModelReference
 from mergekit.moe.config import Expert
 
-import torch.nn as nn
-
 
 def get_hidden_states(
-    model: Union[MistralForCausalLM, LlamaForCausalLM],
-	@@ -115,6 +117,7 @@ def get_gate_params(
+    model: transformers.PreTrainedModel,
+    tokenized: transformers.BatchEncoding,
+    average: bool = True,
+    layer_indices: Optional[List[int]] = None,
+) -> torch.Tensor:
+    if model.device.type == "cuda":
+        # pin so the copy to the GPU can overlap with compute. BatchEncoding.to
+        # only accepts non_blocking in newer transformers releases
+        tokenized = transformers.BatchEncoding(
+            {
+                k: v.pin_memory().to(model.device, non_blocking=True)
+                for k, v in tokenized.items()
+            }
+        )
+    else:
+        tokenized = tokenized.to(model.device)
+    if layer_indices is None:
+        layer_indices = list(range(model.config.num_hidden_layers))
+        capture_all = True
+    else:
+        capture_all = False
+
+    batch_size = tokenized["input_ids"].shape[0]
+    # stay in the model's dtype here - get_gate_params accumulates in float32
+    res = torch.empty(
+        (len(layer_indices), batch_size, model.config.hidden_size),
+        device=model.device,
+        dtype=model.dtype,
+    )  # (num_layers, batch_size, hidden_size)
+    mask = tokenized["attention_mask"].unsqueeze(-1)  # (batch_size, seq_len, 1)
+    num_tokens = mask.sum(dim=1).clamp(min=1)  # (batch_size, 1)
+    # position of the last real token in each sequence, for either padding side
+    seq_len = tokenized["attention_mask"].shape[1]
+    last_idx = (
+        seq_len - 1 - tokenized["attention_mask"].flip(dims=(1,)).argmax(dim=1)
+    )  # (batch_size,)
+    batch_idx = torch.arange(batch_size, device=last_idx.device)
+
+    def _reduce(idx: int, hidden_states: torch.Tensor):
+        if average:
+            # use average over sequence, ignoring padding
+            res[idx] = (hidden_states * mask.to(hidden_states)).sum(
+                dim=1
+            ) / num_tokens.to(hidden_states.device)
+        else:
+            # take last non-padding value
+            res[idx] = hidden_states[
+                batch_idx.to(hidden_states.device), last_idx.to(hidden_states.device)
+            ]
+
+    if capture_all:
+        with torch.inference_mode():
+            output: BaseModelOutputWithPast = model(
+                **tokenized,
+                output_hidden_states=True,
+                return_dict=True,
+                use_cache=False,
+            )
+        # reduce each layer as we go instead of stacking all of them first
+        for idx, hidden_states in enumerate(output.hidden_states[:-1]):
+            _reduce(idx, hidden_states)
+        return res
+
+    # hidden_states[i] is the input to decoder layer i, so hook the inputs of
+    # just the requested layers and reduce them immediately
+    def _make_hook(idx: int):
+        def _hook(_module, args, kwargs):
+            _reduce(idx, args[0] if args else kwargs["hidden_states"])
+
+        return _hook
+
+    handles = [
+        model.base_model.layers[layer_idx].register_forward_pre_hook(
+            _make_hook(idx), with_kwargs=True
+        )
+        for idx, layer_idx in enumerate(layer_indices)
+    ]
+    try:
+        with torch.inference_mode():
+            model(**tokenized, return_dict=True, use_cache=False)
+    finally:
+        for handle in handles:
+            handle.remove()
+    return res
+
+
+def get_cheap_embedding(
+    embed: torch.Tensor,
+    tokenized: Dict[str, torch.Tensor],
+    num_layers: int,
+) -> torch.Tensor:
+    # direct row lookup - avoids materializing a (batch, seq, vocab) one-hot.
+    # if a matmul form is ever needed (e.g. to backprop into a router), build
+    # the one-hot with torch.sparse_coo_tensor rather than a dense tensor.
+    # embed is expected to already be float32 (see get_gate_params)
+    h = torch.nn.functional.embedding(
+        tokenized["input_ids"], embed
+    )  # (batch_size, seq_len, hidden_size)
+    # masked sum over the sequence as a single contraction
+    embedded = torch.einsum(
+        "bsh,bs->bh", h, tokenized["attention_mask"].to(h.dtype)
+    )  # (batch_size, hidden_size)
+    # same for each layer
+    return embedded.unsqueeze(0).expand(
+        num_layers, -1, -1
+    )  # (num_layers, batch_size, hidden_size)
+
+
+def tokenize_prompts(
+    prompts: List[str], tokenizer: transformers.PreTrainedTokenizerBase
+):
+    return tokenizer(
+        [(tokenizer.bos_token or "") + p for p in prompts],
+        return_tensors="pt",
+        padding=True,
+        # keep sequence lengths tensor core friendly
+        pad_to_multiple_of=8,
+        add_special_tokens=False,
+    )
+
+
+def get_gate_params(
+    model_ref: ModelReference,
+    tokenizer: transformers.PreTrainedTokenizerBase,
+    experts: List[Expert],
+    mode: str = "hidden",
+    load_in_4bit: bool = False,
+    load_in_8bit: bool = False,
+    lazy_unpickle: bool = False,
+    trust_remote_code: bool = False,
+    device: str = "auto",
+    batch_size: int = 16,
+):
+    _do_it = None
+
+    model_cfg = model_ref.config(trust_remote_code=trust_remote_code)
+
+    if mode == "random":
+        return torch.randn(
+            (model_cfg.num_hidden_layers, len(experts), model_cfg.hidden_size)
+        )
+    elif mode == "uniform_random":
+        in_features = model_cfg.hidden_size
+        scale = math.sqrt(1.0 / in_features)
+        return (
+            torch.rand(
+                (model_cfg.num_hidden_layers, len(experts), model_cfg.hidden_size)
+            )
+            * 2
+            * scale
+            - scale
+        )
+    elif mode == "cheap_embed":
         embed = model_ref.lazy_loader(lazy_unpickle=lazy_unpickle).get_tensor(
             "model.embed_tokens.weight"
         )
-
+        # cast once up front rather than once per prompt set
+        embed = embed.float().contiguous()
 
         def _do_it(tokenized):
             return get_cheap_embedding(
-	@@ -140,6 +143,18 @@ def _do_it(tokenized):
+                embed,
+                tokenized,
+                num_layers=model_cfg.num_hidden_layers,
+            )
+
+    elif mode in ("hidden", "hidden_avg", "hidden_last"):
+        load_kwargs = dict(
+            revision=model_ref.model.revision,
+            torch_dtype=torch.bfloat16,
+            device_map=device,
+            low_cpu_mem_usage=True,
+            load_in_4bit=load_in_4bit,
+            load_in_8bit=load_in_8bit,
+            trust_remote_code=trust_remote_code,
+        )
+        try:
+            # only hidden states are needed, so skip the LM head entirely
+            model = AutoModel.from_pretrained(model_ref.model.path, **load_kwargs)
+        except ValueError:
+            # remote code models may only register a causal LM class
+            logging.info("No base model class found, loading causal LM instead")
+            model = AutoModelForCausalLM.from_pretrained(
+                model_ref.model.path, **load_kwargs
+            ).base_model
+        # NOTE: torch.compile is deliberately not used here. This runs a
+        # handful of small, variably-shaped batches through the model, so
+        # compile and guard overhead outweighs any kernel speedup - batching
+        # the prompts is what actually pays off.
+
+        def _do_it(tokenized):
             return get_hidden_states(
                 model, tokenized=tokenized, average=mode == "hidden_avg"
             )
+
     elif mode == "model_based":
-            prompt_mapper_model = PromptMapperModel.load_from_checkpoint(
-                "path/to/prompt_mapper_model.ckpt"
+        prompt_mapper_model = PromptMapperModel.load_from_checkpoint(
+            "path/to/prompt_mapper_model.ckpt"
+        )
+        prompt_mapper_model.eval()
+
+        def _do_it(tokenized):
+            with torch.no_grad():
+                expert_probs = prompt_mapper_model(tokenized)
+                expert_probs = expert_probs.permute(
+                    1, 0, 2
+                )  # (num_layers, batch_size, num_experts)
+                return expert_probs
+
+    # flatten prompts for all experts so they can be run in large batches.
+    # segment 2 * i holds the positive prompts for expert i, 2 * i + 1 the negative
+    prompts = []
+    segment_ids = []
+    for expert_idx, expert in enumerate(experts):
+        for sign, expert_prompts in enumerate(
+            (expert.positive_prompts, expert.negative_prompts)
+        ):
+            for prompt in expert_prompts or []:
+                prompts.append(prompt)
+                segment_ids.append(expert_idx * 2 + sign)
+    segment_ids = torch.tensor(segment_ids, dtype=torch.long)
+    num_segments = len(experts) * 2
+
+    if not tokenizer.is_fast:
+        logging.warning(
+            "Using a slow tokenizer - tokenizing expert prompts may take a while"
+        )
+
+    sums = None
+    for start in tqdm.tqdm(
+        range(0, len(prompts), batch_size), desc="expert prompts", unit="batch"
+    ):
+        hidden_states = _do_it(
+            tokenize_prompts(prompts[start : start + batch_size], tokenizer)
+        )  # (num_layers, batch_size, hidden_size)
+        if sums is None:
+            sums = torch.zeros(
+                (hidden_states.shape[0], num_segments, hidden_states.shape[-1]),
+                device=hidden_states.device,
+                dtype=torch.float32,
             )
-            prompt_mapper_model.eval()
-
-            def _do_it(tokenized):
-                with torch.no_grad():
-                    expert_probs = prompt_mapper_model(tokenized)
-                    expert_probs = expert_probs.permute(1, 0, 2)  # (num_layers, batch_size, num_experts)
-                    expert_probs = expert_probs.mean(dim=1)  # (num_layers, num_experts)
-                    return expert_probs
-
-    gate_vecs = []
-    for expert in tqdm.tqdm(experts, desc="expert prompts"):
-	@@ -148,7 +163,7 @@ def _do_it(tokenized):
-            hidden_states -= _do_it(
-                tokenize_prompts(expert.negative_prompts, tokenizer)
+        sums.index_add_(
+            1,
+            segment_ids[start : start + batch_size].to(sums.device),
+            hidden_states.float(),
+        )
+
+    if mode in ("hidden", "hidden_avg", "hidden_last"):
+        # release the model weights before the experts are merged
+        del model, _do_it
+        gc.collect()
+        torch.cuda.empty_cache()
+
+    # everything below works in place on the accumulation buffer
+    counts = torch.bincount(segment_ids, minlength=num_segments).to(sums.device)
+    sums.div_(counts.clamp(min=1).view(1, -1, 1))
+    if mode == "cheap_embed":
+        torch.nn.functional.normalize(sums, p=2, dim=-1, eps=1e-8, out=sums)
+    sums = sums.view(
+        sums.shape[0], len(experts), 2, -1
+    )  # (num_layer, num_expert, 2, hidden_size)
+
+    # experts with no negative prompts have an all-zero negative segment
+    gate_vecs = sums[:, :, 0, :].sub_(sums[:, :, 1, :])
+    # normalize every expert on every layer in one go
+    torch.nn.functional.normalize(gate_vecs, p=2, dim=-1, eps=1e-8, out=gate_vecs)
+    return gate_vecs  # (num_layer, num_expert, hidden_size)
+
+
+def warn_degenerate_gates(gate_vecs: torch.Tensor, threshold: float = 5.0):
+    # batched over layers - one SVD launch and one device sync in total
+    c = torch.linalg.cond(gate_vecs.float())  # (num_layers,)
+    degen_indices = (c > threshold).nonzero(as_tuple=True)[0].tolist()
+
+    if degen_indices:
+        if len(degen_indices) == 1:
+            layer_str = f"layer {degen_indices[0]}"
+            verb = "has"
+        elif len(degen_indices) == 2:
+            layer_str = f"layers {' and '.join(map(str, degen_indices))}"
+            verb = "have"
+        elif len(degen_indices) >= len(gate_vecs):
+            layer_str = "ALL layers"
+            verb = "have"
+        else:
+            layer_str = (
+                "layers "
+                + ", ".join(map(str, degen_indices[:-1]))
+                + ", and "
+                + str(degen_indices[-1])
             )
-    
-        hidden_states /= hidden_states.norm(p=2, dim=-1, keepdim=True).clamp(min=1e-8)
-        gate_vecs.append(hidden_states)
-    gate_vecs = torch.stack(gate_vecs, dim=0)  # (num_expert, num_layer, hidden_size)
-	@@ -187,3 +202,45 @@ def warn_degenerate_gates(gate_vecs: torch.Tensor, threshold: float = 5.0):
+            verb = "have"
+
+        logging.warning(
+            f"{layer_str} {verb} degenerate routing parameters "
             "- your prompts may be too similar."
         )
         logging.warning("One or more experts will be underutilized in your model.")
 
 
-
 class PromptMapperModel(nn.Module):
     def __init__(self, model_name, num_experts, num_layers):
         super().__init__()
@@ -61,12 +337,16 @@ class PromptMapperModel(nn.Module):
         self.encoder = AutoModel.from_pretrained(model_name)
         self.num_experts = num_experts
         self.num_layers = num_layers
-        self.projection = nn.Linear(self.encoder.config.hidden_size, num_experts * num_layers)
+        self.projection = nn.Linear(
+            self.encoder.config.hidden_size, num_experts * num_layers
+        )
 
     def forward(self, prompts):
         inputs = self.tokenizer(prompts, padding=True, return_tensors="pt")
         outputs = self.encoder(**inputs)
-        sequence_output = outputs.last_hidden_state[:, 0, :]  # Take the [CLS] token representation
+        sequence_output = outputs.last_hidden_state[
+            :, 0, :
+        ]  # Take the [CLS] token representation
         logits = self.projection(sequence_output)
         logits = logits.view(-1, self.num_layers, self.num_experts)
         probs = nn.Softmax(dim=-1)(logits)
@@ -0,0 +1,248 @@
+import pytest
+import torch
+import transformers
+from common import make_picollama
+from test_tokenizer import make_tokenizer
+from transformers import BatchEncoding
+from transformers.modeling_outputs import BaseModelOutputWithPast
+
+from mergekit.common import ModelReference
+from mergekit.io import LazyTensorLoader
+from mergekit.moe.config import Expert
+from mergekit.moe.router import (
+    get_cheap_embedding,
+    get_gate_params,
+    get_hidden_states,
+    tokenize_prompts,
+    warn_degenerate_gates,
+)
+
+WORDS = ["alpha", "beta", "gamma", "delta", "epsilon", "zeta", "eta", "theta"]
+
+
+@pytest.fixture(scope="session")
+def model_path(tmp_path_factory):
+    path = make_picollama(tmp_path_factory.mktemp("model_router"), vocab_size=72)
+    make_tokenizer(vocab_size=64, added_tokens=WORDS).save_pretrained(path)
+    return path
+
+
+@pytest.fixture(scope="session")
+def tokenizer(model_path):
+    tok = make_tokenizer(vocab_size=64, added_tokens=WORDS)
+    tok.padding_side = "left"
+    tok.pad_token_id = tok.bos_token_id
+    return tok
+
+
+@pytest.fixture(scope="session")
+def experts(model_path):
+    return [
+        Expert(
+            source_model=model_path,
+            positive_prompts=["alpha beta", "gamma", "alpha alpha delta"],
+        ),
+        Expert(
+            source_model=model_path,
+            positive_prompts=["epsilon zeta eta"],
+            negative_prompts=["alpha", "theta beta"],
+        ),
+        Expert(source_model=model_path, positive_prompts=["theta"]),
+    ]
+
+
+class TestCheapEmbedding:
+    def test_matches_onehot(self):
+        vocab_size, hidden_size, num_layers = 64, 16, 3
+        embed = torch.randn(vocab_size, hidden_size, dtype=torch.bfloat16)
+        tokenized = {
+            "input_ids": torch.randint(0, vocab_size, (2, 5)),
+            "attention_mask": torch.tensor([[1, 1, 1, 1, 1], [0, 0, 1, 1, 1]]),
+        }
+
+        onehot = torch.nn.functional.one_hot(
+            tokenized["input_ids"], num_classes=vocab_size
+        )
+        h = onehot.float() @ embed.float()
+        expected = (h * tokenized["attention_mask"].unsqueeze(-1)).sum(dim=1)
+
+        res = get_cheap_embedding(embed.float(), tokenized, num_layers=num_layers)
+        assert res.shape == (num_layers, 2, hidden_size)
+        for idx in range(num_layers):
+            assert torch.allclose(res[idx], expected, atol=1e-5)
+
+
+class FakeModel:
+    """Returns fixed hidden states regardless of input."""
+
+    device = torch.device("cpu")
+    dtype = torch.float32
+
+    def __init__(self, hidden_states):
+        self.hidden_states = hidden_states
+        self.config = transformers.PretrainedConfig(
+            num_hidden_layers=len(hidden_states) - 1,
+            hidden_size=hidden_states[0].shape[-1],
+        )
+
+    def __call__(self, **kwargs):
+        return BaseModelOutputWithPast(hidden_states=self.hidden_states)
+
+
+class TestHiddenStates:
+    @pytest.fixture
+    def layer_states(self):
+        # (num_layers + 1) x (batch_size, seq_len, hidden_size)
+        return tuple(torch.randn(2, 4, 8) for _ in range(3))
+
+    @pytest.fixture
+    def tokenized(self):
+        return BatchEncoding(
+            {
+                "input_ids": torch.zeros(2, 4, dtype=torch.long),
+                "attention_mask": torch.tensor([[1, 1, 1, 1], [0, 0, 1, 1]]),
+            }
+        )
+
+    def test_average_ignores_padding(self, layer_states, tokenized):
+        res = get_hidden_states(FakeModel(layer_states), tokenized, average=True)
+        assert res.shape == (2, 2, 8)
+        for idx in range(2):
+            assert torch.allclose(res[idx, 0], layer_states[idx][0].mean(dim=0))
+            assert torch.allclose(res[idx, 1], layer_states[idx][1, 2:].mean(dim=0))
+
+    def test_last(self, layer_states, tokenized):
+        res = get_hidden_states(FakeModel(layer_states), tokenized, average=False)
+        for idx in range(2):
+            assert torch.allclose(res[idx], layer_states[idx][:, -1])
+
+    def test_last_right_padded(self, layer_states, tokenized):
+        tokenized["attention_mask"] = torch.tensor([[1, 1, 1, 1], [1, 1, 0, 0]])
+        res = get_hidden_states(FakeModel(layer_states), tokenized, average=False)
+        for idx in range(2):
+            assert torch.allclose(res[idx, 0], layer_states[idx][0, -1])
+            assert torch.allclose(res[idx, 1], layer_states[idx][1, 1])
+
+    def test_layer_indices(self, model_path, tokenizer):
+        model = transformers.AutoModel.from_pretrained(model_path)
+        tokenized = tokenize_prompts(["alpha beta", "gamma delta eta"], tokenizer)
+        for average in (True, False):
+            full = get_hidden_states(model, tokenized, average=average)
+            subset = get_hidden_states(
+                model, tokenized, average=average, layer_indices=[1]
+            )
+            assert subset.shape == (1, 2, 32)
+            assert torch.allclose(subset[0], full[1])
+
+
+class TestGateParams:
+    def test_cheap_embed_matches_reference(self, model_path, tokenizer, experts):
+        model_ref = ModelReference.parse(model_path)
+        embed = (
+            LazyTensorLoader.from_disk(model_path)
+            .get_tensor("model.embed_tokens.weight")
+            .float()
+        )
+
+        def _embed(prompts):
+            tokenized = tokenizer(
+                [tokenizer.bos_token + p for p in prompts],
+                return_tensors="pt",
+                padding=True,
+                add_special_tokens=False,
+            )
+            res = (
+                embed[tokenized["input_ids"]]
+                * tokenized["attention_mask"].unsqueeze(-1)
+            ).sum(dim=(0, 1))
+            return res / res.norm()
+
+        expected = []
+        for expert in experts:
+            vec = _embed(expert.positive_prompts)
+            if expert.negative_prompts:
+                vec = vec - _embed(expert.negative_prompts)
+            expected.append(vec / vec.norm())
+        expected = torch.stack(expected, dim=0)
+
+        for batch_size in (1, 2, 16):
+            gate_vecs = get_gate_params(
+                model_ref,
+                tokenizer,
+                experts,
+                mode="cheap_embed",
+                batch_size=batch_size,
+            )
+            assert gate_vecs.shape == (2, len(experts), 32)
+            for layer_idx in range(gate_vecs.shape[0]):
+                assert torch.allclose(gate_vecs[layer_idx], expected, atol=1e-5)
+
+    @pytest.mark.parametrize("mode", ["hidden", "hidden_avg", "hidden_last"])
+    def test_hidden_matches_reference(self, model_path, tokenizer, experts, mode):
+        model = transformers.AutoModel.from_pretrained(model_path)
+
+        def _hidden(prompts):
+            # one unpadded prompt at a time, in float32
+            res = []
+            for prompt in prompts:
+                tokenized = tokenizer(
+                    [tokenizer.bos_token + prompt],
+                    return_tensors="pt",
+                    add_special_tokens=False,
+                )
+                with torch.no_grad():
+                    output = model(**tokenized, output_hidden_states=True)
+                hidden_states = torch.stack(output.hidden_states[:-1])[:, 0]
+                if mode == "hidden_avg":
+                    res.append(hidden_states.mean(dim=1))
+                else:
+                    res.append(hidden_states[:, -1])
+            return torch.stack(res).mean(dim=0)  # (num_layers, hidden_size)
+
+        expected = []
+        for expert in experts:
+            vec = _hidden(expert.positive_prompts)
+            if expert.negative_prompts:
+                vec = vec - _hidden(expert.negative_prompts)
+            expected.append(vec / vec.norm(dim=-1, keepdim=True))
+        expected = torch.stack(expected, dim=1)  # (num_layers, num_experts, hidden)
+
+        for batch_size in (1, 2, 16):
+            gate_vecs = get_gate_params(
+                ModelReference.parse(model_path),
+                tokenizer,
+                experts,
+                mode=mode,
+                device="cpu",
+                batch_size=batch_size,
+            )
+            assert gate_vecs.shape == (2, len(experts), 32)
+            assert torch.allclose(gate_vecs, expected, atol=5e-3)
+
+    def test_causal_lm_fallback(self, model_path, tokenizer, experts, monkeypatch):
+        model_ref = ModelReference.parse(model_path)
+        expected = get_gate_params(
+            model_ref, tokenizer, experts, mode="hidden", device="cpu"
+        )
+
+        def _no_base_model(*args, **kwargs):
+            raise ValueError("Unrecognized configuration class")
+
+        monkeypatch.setattr(transformers.AutoModel, "from_pretrained", _no_base_model)
+        gate_vecs = get_gate_params(
+            model_ref, tokenizer, experts, mode="hidden", device="cpu"
+        )
+        assert torch.allclose(gate_vecs, expected)
+
+
+class TestDegenerateGates:
+    def test_warns_on_degenerate_layers(self, caplog):
+        gate_vecs = torch.eye(4).unsqueeze(0).repeat(3, 1, 1)
+        gate_vecs[1, 1] = gate_vecs[1, 0]
+        gate_vecs[2, 3] = gate_vecs[2, 2] + 1e-3
+        warn_degenerate_gates(gate_vecs)
+        assert "layers 1 and 2 have degenerate routing parameters" in caplog.text
+
+    def test_no_warning(self, caplog):
+        warn_degenerate_gates(torch.eye(4).unsqueeze(0).repeat(3, 1, 1))
+        assert "degenerate" not in caplog.text